@@ -0,0 +1,32 @@
+"""
+Elección del fichero ONNX de all-MiniLM-L6-v2, compartida por rag_tool.py,
+pdf_loader.py y google_adk_rag_tools/tools.py.
+
+Solo usa la biblioteca estándar: importarlo no carga torch ni ONNX Runtime.
+"""
+
+import os
+
+ONNX_QINT8_VNNI_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+ONNX_FP32_FILE = "onnx/model.onnx"
+
+
+def _cpu_has_avx512_vnni() -> bool:
+    """True si /proc/cpuinfo anuncia AVX512-VNNI (False fuera de Linux)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            return "avx512_vnni" in f.read()
+    except OSError:
+        return False
+
+
+def onnx_model_file() -> str:
+    """
+    Fichero ONNX según la CPU: el modelo int8 (u8s8) solo compensa con AVX512-VNNI;
+    sin esas instrucciones es más lento y pierde precisión, así que se usa el FP32.
+    RAG_ONNX_MODEL_FILE fuerza un fichero concreto.
+    """
+    override = os.getenv("RAG_ONNX_MODEL_FILE")
+    if override:
+        return override
+    return ONNX_QINT8_VNNI_FILE if _cpu_has_avx512_vnni() else ONNX_FP32_FILE
@@ -0,0 +1,79 @@
+"""
+Caché persistente de embeddings.
+
+Guarda el embedding de cada chunk indexado por el SHA-256 de su texto (y del
+modelo que lo generó), para no recalcularlo al volver a añadir el mismo contenido.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+# Máximo de parámetros por sentencia (SQLite antiguo admite 999)
+_SQL_BATCH = 500
+
+
+class EmbeddingCache:
+    """Diccionario SHA-256(texto) -> embedding float32 en SQLite, con límite LRU."""
+
+    def __init__(self, path: str, model_id: str, max_entries: int = 100_000):
+        self._model_id = model_id
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+
+    def _key(self, text: str) -> bytes:
+        """Clave del texto; incluye el modelo para no mezclar espacios de embeddings."""
+        return hashlib.sha256(f"{self._model_id}\0{text}".encode("utf-8")).digest()
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Devuelve el embedding de cada texto, o None si no está en la caché."""
+        keys = [self._key(text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), _SQL_BATCH):
+                batch = keys[start:start + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                found.update(self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall())
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self._conn.commit()
+        return [np.frombuffer(found[key], dtype=np.float32) if key in found else None for key in keys]
+
+    def put_many(self, texts: Sequence[str], vectors: np.ndarray) -> None:
+        """Guarda los embeddings y descarta los menos usados si se supera el límite."""
+        now = time.time()
+        rows = [
+            (self._key(text), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows
+            )
+            excess = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self._max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,)
+                )
+            self._conn.commit()
@@ -7,62 +7,265 @@ Todo funciona offline con modelos ligeros.
 
 import os
 import time
+import hashlib
+import mmap
 import logging
 import json
+import multiprocessing
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 
-# Imports simples
-import fitz  # PyMuPDF
-from sentence_transformers import SentenceTransformer
-import chromadb
+# Imports simples. PyMuPDF, sentence-transformers y chromadb se importan al
+# primer uso. Por defecto un hilo de precalentamiento los carga justo después del
+# import; con RAG_WARMUP=0 importar este módulo (p. ej. solo para registrar las
+# herramientas) no arrastra torch ni el cliente de ChromaDB
+import numpy as np
+
+try:
+    from ._embedding_cache import EmbeddingCache
+except ImportError:
+    # tools.py importado como módulo suelto (p. ej. desde run_example.py)
+    from _embedding_cache import EmbeddingCache
+
+# La elección del fichero ONNX se comparte con rag_tool.py y pdf_loader.py, en
+# archivist_agent/agent/ (run_example.py solo añade este directorio al path)
+_AGENT_DIR = str(Path(__file__).resolve().parent.parent)
+if _AGENT_DIR not in sys.path:
+    sys.path.append(_AGENT_DIR)
+from _embedding_backend import onnx_model_file
 
 logger = logging.getLogger(__name__)
 
+# Modelo de embeddings. Por defecto se ejecuta con ONNX Runtime, con pesos
+# cuantizados a int8 si la CPU los acelera (ficheros publicados junto al modelo);
+# RAG_EMBEDDING_BACKEND=torch fuerza PyTorch en FP32
+_EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+_EMBEDDING_BACKEND = os.getenv("RAG_EMBEDDING_BACKEND", "onnx")
+_ONNX_MODEL_FILE = onnx_model_file()
+
+# Directorio de persistencia de ChromaDB (y de la caché de embeddings)
+_PERSIST_DIR = "./vectorstore_data"
+
 # Variables globales simples
+_fitz = None
+_PDF_TEXT_FLAGS = 0
 _embedding_model = None
+_embedding_lock = threading.Lock()
+_embedding_model_id = None
+_embedding_cache = None
 _chroma_client = None
 _collection = None
+_collection_space = "ip"  # métrica de la colección abierta; ver _HNSW_METADATA
+_collection_count = None  # número de chunks; se recalcula tras escribir o al caducar
+_collection_count_expires = 0.0
+_chroma_lock = threading.Lock()
+
+# Otros procesos pueden escribir en la misma colección: el recuento cacheado caduca
+_COLLECTION_COUNT_TTL = 30.0
+
+# Tamaño de lote al generar embeddings de los chunks
+_ENCODE_BATCH_SIZE = 64
+
+# Parámetros HNSW de la colección (solo se aplican al crearla). Los valores por
+# defecto de Chroma (M=16, construction_ef=100, search_ef=10) pierden recall en
+# RAG; un grafo algo más denso cuesta más memoria y tiempo de indexado a cambio de
+# mejor recall por consulta. Los embeddings se guardan ya normalizados, así que
+# el producto interno es la similitud coseno sin renormalizar en cada consulta;
+# la distancia "ip" de Chroma es 1 - producto, luego score = 1 - distancia.
+# Las colecciones creadas antes sin "hnsw:space" usan "l2" (distancia euclídea al
+# cuadrado); _distance_to_score la convierte, pero sus chunks se guardaron sin
+# normalizar y el score solo es aproximado: conviene reconstruirlas.
+# No bajar estos valores sin medir el recall.
+_HNSW_METADATA = {
+    "hnsw:space": "ip",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100
+}
+
+# Caché de consultas: clave (consulta normalizada, top_k, source) -> (embedding,
+# resultados, caducidad). Como el recuento, caduca porque otros procesos pueden
+# escribir en la colección; las escrituras de este proceso la vacían y cambian
+# la generación, para descartar resultados de consultas que estaban en curso
+_QUERY_CACHE_SIZE = 512
+_QUERY_CACHE_TTL = 30.0
+# Reutilizar los resultados de una consulta parecida (no idéntica) es opcional:
+# MiniLM da similitudes altísimas a consultas que solo cambian un año, un número
+# de caso o una negación. RAG_SEMANTIC_QUERY_CACHE=1 lo activa con un umbral estricto
+_QUERY_CACHE_SEMANTIC = os.getenv("RAG_SEMANTIC_QUERY_CACHE", "0") == "1"
+_QUERY_CACHE_SIMILARITY = 0.995
+_query_cache: "OrderedDict[Tuple[str, int, str], Tuple[np.ndarray, List[dict], float]]" = OrderedDict()
+_query_cache_generation = 0
+_query_cache_lock = threading.Lock()
+
+def _import_fitz():
+    """Importa PyMuPDF al primer uso."""
+    global _fitz, _PDF_TEXT_FLAGS
+    if _fitz is None:
+        try:
+            import fitz  # PyMuPDF
+        except ImportError:
+            raise Exception("PyMuPDF no está instalado. Instala con: pip install PyMuPDF")
+
+        # MuPDF escribe en stderr cada aviso de PDFs mal formados; con la extracción en
+        # paralelo esos avisos compiten por stderr. Siguen disponibles en fitz.TOOLS.mupdf_warnings()
+        fitz.TOOLS.mupdf_display_errors(False)
+
+        # Flags de extracción: conserva espacios y recorta al área de la página, pero sin
+        # TEXT_PRESERVE_LIGATURES, así "ﬁ" llega como "fi" y se tokeniza como texto normal
+        _PDF_TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+        _fitz = fitz
+    return _fitz
 
 def _get_embedding_model():
     """Carga el modelo de embeddings de forma lazy."""
-    global _embedding_model
     if _embedding_model is None:
-        if SentenceTransformer is None:
+        with _embedding_lock:
+            _load_embedding_model()
+    return _embedding_model
+
+def _load_embedding_model():
+    """Carga el modelo de embeddings si nadie lo ha cargado aún."""
+    global _embedding_model, _embedding_model_id
+    if _embedding_model is None:
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
             raise Exception("sentence-transformers no está instalado. Instala con: pip install sentence-transformers")
         
-        try:
-            print("Cargando modelo de embeddings (puede tardar unos segundos la primera vez)...")
-            _embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-            print("✓ Modelo cargado correctamente")
-        except Exception as e:
-            raise Exception(f"Error cargando modelo de embeddings: {str(e)}")
-    return _embedding_model
+        print("Cargando modelo de embeddings (puede tardar unos segundos la primera vez)...")
+        model = None
+        # El extra [onnx] instala onnxruntime para CPU: con GPU se usa PyTorch, que
+        # SentenceTransformer coloca en CUDA automáticamente
+        import torch
+        if _EMBEDDING_BACKEND == "onnx" and not torch.cuda.is_available():
+            try:
+                model = SentenceTransformer(
+                    _EMBEDDING_MODEL_NAME,
+                    backend="onnx",
+                    model_kwargs={"file_name": _ONNX_MODEL_FILE}
+                )
+                model_id = f"{_EMBEDDING_MODEL_NAME}:onnx:{_ONNX_MODEL_FILE}:normalized"
+            except Exception as e:
+                logger.warning("No se pudo cargar el modelo ONNX, se usa PyTorch: %s", e)
+        
+        if model is None:
+            try:
+                model = SentenceTransformer(_EMBEDDING_MODEL_NAME)
+                model_id = f"{_EMBEDDING_MODEL_NAME}:torch:normalized"
+            except Exception as e:
+                raise Exception(f"Error cargando modelo de embeddings: {str(e)}")
+
+        # _get_embedding_model() comprueba _embedding_model sin el lock: el modelo se
+        # publica el último, cuando su id ya está disponible
+        _embedding_model_id = model_id
+        _embedding_model = model
+        print("✓ Modelo cargado correctamente")
 
 def _get_chroma_collection():
-    """Obtiene o crea la colección de ChromaDB."""
-    global _chroma_client, _collection
+    """Obtiene o crea la colección de ChromaDB (una sola instancia por proceso)."""
+    global _chroma_client, _collection, _collection_space
     
-    if _collection is None:
-        if chromadb is None:
-            raise Exception("chromadb no está instalado. Instala con: pip install chromadb")
-        
-        # Crear directorio si no existe
-        persist_dir = "./vectorstore_data"
-        os.makedirs(persist_dir, exist_ok=True)
-        
-        # Cliente persistente
-        _chroma_client = chromadb.PersistentClient(path=persist_dir)
-        
-        # Obtener o crear colección
-        try:
-            _collection = _chroma_client.get_collection("google_adk_docs")
-        except:
-            _collection = _chroma_client.create_collection("google_adk_docs")
+    if _collection is not None:
+        return _collection
+
+    with _chroma_lock:
+        if _collection is None:
+            try:
+                import chromadb
+            except ImportError:
+                raise Exception("chromadb no está instalado. Instala con: pip install chromadb")
+            
+            # Crear directorio si no existe
+            os.makedirs(_PERSIST_DIR, exist_ok=True)
+            
+            # Cliente persistente
+            _chroma_client = chromadb.PersistentClient(path=_PERSIST_DIR)
+            
+            # Obtener o crear colección
+            try:
+                _collection = _chroma_client.get_collection("google_adk_docs")
+            except:
+                _collection = _chroma_client.create_collection(
+                    "google_adk_docs",
+                    metadata=_HNSW_METADATA
+                )
+            _collection_space = _get_collection_space(_collection)
     
     return _collection
 
-def _extract_text(file_path: str) -> str:
+def _get_collection_space(collection) -> str:
+    """Métrica HNSW de la colección ("l2" si se creó sin indicarla)."""
+    try:
+        space = (collection.configuration or {}).get("hnsw", {}).get("space")
+    except Exception:
+        # Versiones de chromadb sin configuración de colección
+        space = None
+    return space or (collection.metadata or {}).get("hnsw:space", "l2")
+
+def _distance_to_score(distance: float) -> float:
+    """Convierte la distancia de Chroma en similitud coseno para embeddings normalizados."""
+    if _collection_space == "l2":
+        # Chroma devuelve la distancia euclídea al cuadrado: ||a - b||² = 2 - 2·cos
+        return 1.0 - distance / 2.0
+    # "ip" y "cosine": distancia = 1 - similitud
+    return 1.0 - distance
+
+def _get_embedding_cache() -> EmbeddingCache:
+    """Abre la caché persistente de embeddings del modelo cargado."""
+    global _embedding_cache
+    if _embedding_cache is None:
+        _get_embedding_model()
+        with _embedding_lock:
+            if _embedding_cache is None:
+                os.makedirs(_PERSIST_DIR, exist_ok=True)
+                _embedding_cache = EmbeddingCache(
+                    os.path.join(_PERSIST_DIR, "embedding_cache.sqlite3"),
+                    model_id=_embedding_model_id
+                )
+    return _embedding_cache
+
+def _reset_chroma_after_fork():
+    """En un proceso hijo descarta el cliente heredado; se abrirá uno propio al usarlo."""
+    global _chroma_client, _collection, _collection_count, _chroma_lock, _embedding_cache, _embedding_lock
+    _chroma_client = None
+    _collection = None
+    _collection_count = None
+    _chroma_lock = threading.Lock()
+    _embedding_cache = None
+    _embedding_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_chroma_after_fork)
+
+# Páginas que procesa cada tarea del pool; amortiza el coste de abrir el PDF en cada worker
+_PDF_PAGES_PER_TASK = 10
+# Por debajo de este número de páginas no compensa arrancar procesos
+_PDF_PARALLEL_MIN_PAGES = 20
+
+def _extract_pdf_pages(file_path: str, start: int, stop: int) -> str:
+    """Extrae el texto de las páginas [start, stop) de un PDF. Se ejecuta en un worker."""
+    doc = _import_fitz().open(file_path)
+    try:
+        return "".join(doc[i].get_text("text", flags=_PDF_TEXT_FLAGS, sort=False) for i in range(start, stop))
+    finally:
+        doc.close()
+
+def _extract_pdf_parallel(file_path: str, page_count: int) -> str:
+    """Extrae el texto de un PDF repartiendo bloques de páginas entre varios procesos."""
+    starts = range(0, page_count, _PDF_PAGES_PER_TASK)
+    stops = [min(start + _PDF_PAGES_PER_TASK, page_count) for start in starts]
+    max_workers = min(os.cpu_count() or 1, len(stops))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # map conserva el orden de los bloques, así que basta con unirlos
+        return "".join(executor.map(_extract_pdf_pages, repeat(file_path), starts, stops))
+
+def _extract_text(file_path: str, parallel: bool = True) -> str:
     """Extrae texto de un archivo."""
     if not os.path.exists(file_path):
         raise Exception(f"Archivo no encontrado: {file_path}")
@@ -70,22 +273,35 @@ def _extract_text(file_path: str) -> str:
     ext = Path(file_path).suffix.lower()
     
     if ext == '.pdf':
-        if fitz is None:
-            raise Exception("PyMuPDF no está instalado. Instala con: pip install PyMuPDF")
-        doc = fitz.open(file_path)
-        text = ""
-        for page in doc:
-            text += page.get_text()
+        doc = _import_fitz().open(file_path)
+        page_count = doc.page_count
+        if parallel and page_count >= _PDF_PARALLEL_MIN_PAGES:
+            doc.close()
+            return _extract_pdf_parallel(file_path, page_count).strip()
+        # Acumular por páginas y unir una sola vez: coste lineal en el tamaño del texto
+        parts = [page.get_text("text", flags=_PDF_TEXT_FLAGS, sort=False) for page in doc]
         doc.close()
-        return text.strip()
+        return "".join(parts).strip()
     
     elif ext in ['.txt', '.md', '.markdown']:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read().strip()
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            # Decodificar directamente desde la proyección en memoria del archivo,
+            # sin una copia intermedia en bytes
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                text = str(mm, 'utf-8')
+        # Mismos saltos de línea que la lectura en modo texto
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return text.strip()
     
     else:
         raise Exception(f"Formato no soportado: {ext}. Soportados: .pdf, .txt, .md")
 
+# Caracteres donde se prefiere cortar un chunk
+_CHUNK_SEPARATORS = '.!?\n'
+
 def _chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
     """Divide texto en chunks."""
     if len(text) <= chunk_size:
@@ -97,11 +313,11 @@ def _chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[s
     while start < len(text):
         end = start + chunk_size
         if end < len(text):
-            # Buscar punto de corte natural
-            for i in range(end - 1, start + chunk_size - 100, -1):
-                if text[i] in '.!?\n':
-                    end = i + 1
-                    break
+            # Buscar punto de corte natural en los últimos 99 caracteres; rfind
+            # recorre el texto en C en lugar de carácter a carácter en Python
+            cut = max(text.rfind(sep, max(end - 99, start), end) for sep in _CHUNK_SEPARATORS)
+            if cut != -1:
+                end = cut + 1
         
         chunk = text[start:end].strip()
         if chunk:
@@ -114,6 +330,120 @@ def _chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[s
     
     return chunks
 
+def _cache_get(cache_key: Tuple[str, int, str]) -> Tuple[Optional[List[dict]], int]:
+    """Devuelve los resultados cacheados para una consulta idéntica y la generación actual."""
+    with _query_cache_lock:
+        entry = _query_cache.get(cache_key)
+        if entry is None:
+            return None, _query_cache_generation
+        if entry[2] < time.monotonic():
+            del _query_cache[cache_key]
+            return None, _query_cache_generation
+        _query_cache.move_to_end(cache_key)
+        return [dict(result) for result in entry[1]], _query_cache_generation
+
+def _cache_get_similar(query_embedding: np.ndarray, top_k: int, source: str) -> Optional[List[dict]]:
+    """Devuelve los resultados cacheados de la consulta más parecida, si supera el umbral."""
+    with _query_cache_lock:
+        now = time.monotonic()
+        keys = [key for key, entry in _query_cache.items() if key[1:] == (top_k, source) and entry[2] >= now]
+        if not keys:
+            return None
+        # Los embeddings están normalizados: el producto interno es la similitud coseno
+        scores = np.stack([_query_cache[key][0] for key in keys]) @ query_embedding
+        best = int(np.argmax(scores))
+        if scores[best] < _QUERY_CACHE_SIMILARITY:
+            return None
+        _query_cache.move_to_end(keys[best])
+        return [dict(result) for result in _query_cache[keys[best]][1]]
+
+def _cache_put(cache_key: Tuple[str, int, str], query_embedding: np.ndarray, results: List[dict],
+               generation: int) -> None:
+    """Guarda los resultados de una consulta, salvo que la colección haya cambiado mientras tanto."""
+    with _query_cache_lock:
+        if generation != _query_cache_generation:
+            return
+        _query_cache[cache_key] = (
+            query_embedding,
+            [dict(result) for result in results],
+            time.monotonic() + _QUERY_CACHE_TTL
+        )
+        _query_cache.move_to_end(cache_key)
+        while len(_query_cache) > _QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+
+def _cache_clear() -> None:
+    """Vacía la caché de consultas (la colección ha cambiado) y cambia de generación."""
+    global _query_cache_generation
+    with _query_cache_lock:
+        _query_cache_generation += 1
+        _query_cache.clear()
+
+def _get_collection_count() -> int:
+    """Número de chunks de la colección, sin consultar a Chroma en cada búsqueda."""
+    global _collection_count, _collection_count_expires
+    if _collection_count is None or time.monotonic() >= _collection_count_expires:
+        count = _get_chroma_collection().count()
+        # Un 0 no se cachea: la colección vacía puede llenarla otro proceso en cualquier momento
+        _collection_count = count if count else None
+        _collection_count_expires = time.monotonic() + _COLLECTION_COUNT_TTL
+        return count
+    return _collection_count
+
+def _collection_changed() -> None:
+    """Invalida todo lo derivado del contenido de la colección."""
+    global _collection_count
+    _collection_count = None
+    _cache_clear()
+
+def _encode_chunks(chunks: List[str]) -> np.ndarray:
+    """Genera los embeddings de los chunks; solo pasa por el modelo lo que no está en caché."""
+    model = _get_embedding_model()
+    try:
+        cache = _get_embedding_cache()
+        vectors = cache.get_many(chunks)
+    except Exception as e:
+        logger.warning("Caché de embeddings no disponible: %s", e)
+        cache = None
+        vectors = [None] * len(chunks)
+
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        missing_chunks = [chunks[i] for i in missing]
+        # encode() ya ordena internamente por longitud para minimizar el padding
+        fresh = model.encode(
+            missing_chunks,
+            batch_size=_ENCODE_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        for i, vector in zip(missing, fresh):
+            vectors[i] = vector
+        if cache is not None:
+            try:
+                cache.put_many(missing_chunks, fresh)
+            except Exception as e:
+                logger.warning("No se pudieron guardar embeddings en caché: %s", e)
+
+    return np.stack(vectors).astype(np.float32, copy=False)
+
+def _chunk_batches(chunks: List[str], embeddings: np.ndarray, file_name: str, fingerprint: str,
+                   batch_size: int) -> Iterator[Dict[str, Any]]:
+    """Genera los argumentos de collection.add() lote a lote, sin materializar ids ni metadatos."""
+    for start in range(0, len(chunks), batch_size):
+        stop = min(start + batch_size, len(chunks))
+        yield {
+            "documents": chunks[start:stop],
+            "embeddings": embeddings[start:stop],
+            "metadatas": [{
+                "filename": file_name,
+                "fingerprint": fingerprint,
+                "chunk_index": i
+            } for i in range(start, stop)],
+            "ids": [f"{file_name}_{i}" for i in range(start, stop)]
+        }
+
 
 def add_document_to_knowledge_base(case_information: str) -> dict:
     """
@@ -148,47 +478,52 @@ def add_document_to_knowledge_base(case_information: str) -> dict:
                 "processing_time": round(time.time() - start_time, 2)
             }
         
-        # Crear chunks
-        chunks = _chunk_text(text)
-        
-        # Generar embeddings
-        model = _get_embedding_model()
-        embeddings = model.encode(chunks)
+        # La herramienta recibe texto, no un archivo: el documento se identifica
+        # por la huella de su contenido
+        fingerprint = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        file_name = f"case_{fingerprint[:16]}"
         
         # Obtener colección
         collection = _get_chroma_collection()
         
-        # Eliminar documento existente si existe
-        file_name = os.path.basename(file_path)
-        try:
-            existing = collection.get(where={"filename": file_name})
-            if existing['ids']:
-                collection.delete(ids=existing['ids'])
-        except:
-            pass
+        # Crear chunks
+        chunks = _chunk_text(text)
         
-        # Añadir chunks
-        ids = [f"{file_name}_{i}" for i in range(len(chunks))]
-        metadatas = [{
-            "filename": file_name,
-            "file_path": file_path,
-            "chunk_index": i
-        } for i in range(len(chunks))]
+        # Si ya están indexados todos los chunks de este contenido no hay nada que hacer;
+        # si solo hay una parte (un add() que falló a medias) se vuelve a insertar entero
+        stored = collection.get(where={"fingerprint": fingerprint}, include=[])
+        if len(stored['ids']) == len(chunks):
+            return {
+                "success": True,
+                "message": f"Documento '{file_name}' sin cambios",
+                "chunks_added": 0,
+                "processing_time": round(time.time() - start_time, 2),
+                "file_name": file_name
+            }
         
-        collection.add(
-            documents=chunks,
-            embeddings=embeddings.tolist(),
-            metadatas=metadatas,
-            ids=ids
-        )
+        # Generar embeddings
+        embeddings = _encode_chunks(chunks)
+        
+        try:
+            # Eliminar los chunks de una inserción interrumpida
+            if stored['ids']:
+                collection.delete(ids=stored['ids'])
+            
+            # Añadir chunks en lotes del tamaño máximo que admite el cliente: un documento
+            # muy largo no debe superar el límite de una sola llamada a add()
+            batch_size = _chroma_client.get_max_batch_size()
+            for batch in _chunk_batches(chunks, embeddings, file_name, fingerprint, batch_size):
+                collection.add(**batch)
+        finally:
+            # Incluso si add() falla a medias la colección puede haber cambiado
+            _collection_changed()
         
         return {
             "success": True,
             "message": f"Documento '{file_name}' procesado exitosamente",
             "chunks_added": len(chunks),
             "processing_time": round(time.time() - start_time, 2),
-            "file_name": file_name,
-            "file_path": file_path
+            "file_name": file_name
         }
         
     except Exception as e:
@@ -200,12 +535,13 @@ def add_document_to_knowledge_base(case_information: str) -> dict:
         }
 
 
-def query_knowledge_base(query: str) -> dict:
+def query_knowledge_base(query: str, source: str = "") -> dict:
     """
     Consulta la base de conocimiento.
     
     Args:
         query: Consulta de texto
+        source: Nombre del documento al que limitar la búsqueda (opcional)
     
     Returns:
         dict: Resultados de la búsqueda
@@ -214,7 +550,6 @@ def query_knowledge_base(query: str) -> dict:
     start_time = time.time()
     
     try:
-        print("1")
         # Validación básica
         if not query or not isinstance(query, str) or not query.strip():
             return {
@@ -228,41 +563,48 @@ def query_knowledge_base(query: str) -> dict:
         if top_k < 1 or top_k > 20:
             top_k = 3
         
-        print("2")
-        # Generar embedding de la consulta
-        model = _get_embedding_model()
-        query_embedding = model.encode([query.strip()])
-        
-        # Buscar en la colección
-        collection = _get_chroma_collection()
-        print("min(top_k, collection.count())")
-        print(min(top_k, collection.count()))
-        print(top_k)
-        print(collection.count())
-
-        results = collection.query(
-            query_embeddings=query_embedding.tolist(),
-            n_results=min(top_k, collection.count()),
-            include=['documents', 'metadatas', 'distances']
-        )
-        
-        print("3")
-        # Formatear resultados
-        formatted_results = []
-        if results['documents'] and results['documents'][0]:
-            for i, doc in enumerate(results['documents'][0]):
-                metadata = results['metadatas'][0][i] if results['metadatas'] else {}
-                distance = results['distances'][0][i] if results['distances'] else 1.0
-                score = 1.0 - distance  # Convertir distancia a similitud
-                
-                formatted_results.append({
-                    "content": doc,
-                    "score": round(score, 4),
-                    "source": metadata.get('filename', 'unknown'),
-                    "file_path": metadata.get('file_path', 'unknown'),
-                    "chunk_index": metadata.get('chunk_index', 0)
-                })
-        print("4")
+        # Consultas repetidas (misma consulta normalizada) no tocan el modelo ni la colección
+        source = source.strip() if isinstance(source, str) else ""
+        cache_key = (" ".join(query.lower().split()), top_k, source)
+        formatted_results, generation = _cache_get(cache_key)
+        if formatted_results is None:
+            # Generar embedding de la consulta
+            model = _get_embedding_model()
+            query_embedding = model.encode([query.strip()], convert_to_numpy=True, normalize_embeddings=True,
+                                           show_progress_bar=False)
+
+            # Una consulta casi idéntica a otra reciente reutiliza sus resultados
+            if _QUERY_CACHE_SEMANTIC:
+                formatted_results = _cache_get_similar(query_embedding[0], top_k, source)
+        if formatted_results is None and _get_collection_count() == 0:
+            # Colección vacía: Chroma no admite n_results=0
+            formatted_results = []
+        if formatted_results is None:
+            # Buscar en la colección
+            collection = _get_chroma_collection()
+            n_results = min(top_k, _get_collection_count())
+            logger.debug("Consultando la colección: n_results=%d, top_k=%d", n_results, top_k)
+
+            results = collection.query(
+                query_embeddings=query_embedding,
+                n_results=n_results,
+                # Filtrar por metadatos antes de recorrer el índice acota la búsqueda
+                where={"filename": source} if source else None,
+                include=['documents', 'metadatas', 'distances']
+            )
+
+            # Formatear resultados: extraer cada columna una vez y recorrerlas juntas
+            documents = results['documents'][0] if results['documents'] else []
+            metadatas = results['metadatas'][0] if results['metadatas'] else [{}] * len(documents)
+            distances = results['distances'][0] if results['distances'] else [1.0] * len(documents)
+            formatted_results = [{
+                "content": doc,
+                "score": round(_distance_to_score(distance), 4),  # Convertir distancia a similitud
+                "source": metadata.get('filename', 'unknown'),
+                "file_path": metadata.get('file_path', 'unknown'),
+                "chunk_index": metadata.get('chunk_index', 0)
+            } for doc, metadata, distance in zip(documents, metadatas, distances)]
+            _cache_put(cache_key, query_embedding[0], formatted_results, generation)
         return {
             "success": True,
             "query": query.strip(),
@@ -273,8 +615,7 @@ def query_knowledge_base(query: str) -> dict:
         }
         
     except Exception as e:
-        print("5")
-        print(e)
+        logger.error("Error en consulta: %s", e)
         return {
             "success": False,
             "query": query.strip() if query else "",
@@ -285,5 +626,26 @@ def query_knowledge_base(query: str) -> dict:
         }
 
 
-_get_embedding_model()
-_get_chroma_collection()
\ No newline at end of file
+def _warm_up() -> None:
+    """Carga modelo y colección, y lanza una consulta desechable para cargar el índice HNSW."""
+    try:
+        model = _get_embedding_model()
+        collection = _get_chroma_collection()
+        if _get_collection_count() == 0:
+            return
+        embedding = model.encode(["warmup"], normalize_embeddings=True)
+        collection.query(
+            query_embeddings=embedding,
+            n_results=1,
+            include=['distances']
+        )
+    except Exception as e:
+        logger.warning("No se pudo precalentar la colección: %s", e)
+
+
+# Precalentar en segundo plano: el import termina enseguida y la primera consulta
+# encuentra el modelo y el índice ya en memoria. RAG_WARMUP=0 lo desactiva, como
+# en rag_tool.py. Los workers de _extract_pdf_parallel no lo necesitan: con spawn o
+# forkserver cada uno reimporta este módulo y cargaría torch, el modelo y Chroma
+if os.getenv("RAG_WARMUP", "1") != "0" and multiprocessing.parent_process() is None:
+    threading.Thread(target=_warm_up, name="rag-warm-up", daemon=True).start()
@@ -1,29 +1,109 @@
 import os
 import glob
+import logging
+from concurrent.futures import ProcessPoolExecutor
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.document_loaders import PyMuPDFLoader, UnstructuredPDFLoader
 from langchain_community.vectorstores import Chroma
 from langchain.chains import RetrievalQA
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
 
 from pathlib import Path
+from _embedding_backend import onnx_model_file
 
-embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-generator = pipeline("text-generation", model="gpt2", tokenizer="gpt2")
+# Modelo de embeddings, ejecutado con ONNX Runtime (int8 si la CPU lo acelera);
+# RAG_EMBEDDING_BACKEND=torch vuelve a PyTorch en FP32
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+if os.getenv("RAG_EMBEDDING_BACKEND", "onnx") == "onnx":
+    EMBEDDING_MODEL_KWARGS = {
+        "backend": "onnx",
+        "model_kwargs": {"file_name": onnx_model_file()},
+    }
+else:
+    EMBEDDING_MODEL_KWARGS = {}
+
+# Parámetros del grafo HNSW (M, construction_ef, search_ef) iguales a los de
+# google_adk_rag_tools: más memoria y tiempo de indexado a cambio de mejor recall
+# que los valores por defecto. La métrica sí difiere: aquí "cosine", porque los
+# embeddings de LangChain no se normalizan; allí "ip" sobre vectores normalizados
+HNSW_COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100,
+}
+
+logger = logging.getLogger(__name__)
+
+# langchain_huggingface y transformers (torch) se importan al primer uso
+_embedding_model = None
+_generator = None
+
+def _get_embedding_model():
+    """Carga el modelo de embeddings una sola vez por proceso."""
+    global _embedding_model
+    if _embedding_model is None:
+        import torch
+        from langchain_huggingface import HuggingFaceEmbeddings
+        # onnxruntime del extra [onnx] es solo CPU: con GPU se queda en PyTorch (CUDA)
+        if EMBEDDING_MODEL_KWARGS and not torch.cuda.is_available():
+            try:
+                _embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME,
+                                                         model_kwargs=EMBEDDING_MODEL_KWARGS)
+            except Exception as e:
+                logger.warning("No se pudo cargar el modelo ONNX, se usa PyTorch: %s", e)
+        if _embedding_model is None:
+            _embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+    return _embedding_model
+
+def _get_generator():
+    """Carga el pipeline generativo local una sola vez por proceso."""
+    global _generator
+    if _generator is None:
+        import torch
+        from transformers import pipeline
+        if torch.cuda.is_available():
+            # En GPU los pesos en FP16 ocupan la mitad y usan los tensor cores
+            _generator = pipeline("text-generation", model="gpt2", tokenizer="gpt2",
+                                  device=0, torch_dtype=torch.float16)
+        else:
+            # En CPU se mantiene FP32: BF16 solo acelera con AVX512-BF16/AMX
+            _generator = pipeline("text-generation", model="gpt2", tokenizer="gpt2")
+    return _generator
+
+def _is_readable_pdf(path: str) -> bool:
+    """Comprueba con PyMuPDF que el PDF abre y tiene al menos una página legible."""
+    import fitz
+    try:
+        with fitz.open(path) as doc:
+            doc.load_page(0)
+        return True
+    except Exception:
+        return False
+
+def _load_one(path: str):
+    """Carga un PDF en un proceso hijo; devuelve (path, docs, error) para registrar en el padre."""
+    try:
+        if _is_readable_pdf(path):
+            docs = PyMuPDFLoader(path).load()
+        else:
+            docs = UnstructuredPDFLoader(path).load()
+        return path, docs, None
+    except Exception as e:
+        return path, [], repr(e)
 
 # Función para cargar los documentos PDF en un directorio
 def load_pdf_documents(pdf_dir: str):
     pdf_paths = glob.glob(os.path.join(pdf_dir, "*.pdf"))
-    documents = []
-    for path in pdf_paths:
-        try:
-            loader = PyMuPDFLoader(path)
-        except Exception:
-            loader = UnstructuredPDFLoader(path)
-        docs = loader.load()
-        documents.extend(docs)
-    return documents
+    if len(pdf_paths) > 1:
+        # El parseo de PyMuPDF es CPU-bound: un proceso por PDF esquiva el GIL
+        with ProcessPoolExecutor(max_workers=min(8, os.cpu_count() or 1, len(pdf_paths))) as ex:
+            results = list(ex.map(_load_one, pdf_paths))
+    else:
+        results = [_load_one(path) for path in pdf_paths]
+    for path, _, err in results:
+        if err is not None:
+            logger.error("No se pudo cargar %s: %s", path, err)
+    return [doc for _, docs, _ in results for doc in docs]
 
 # Función para construir el vectorstore
 def build_vectorstore(documents, persist_dir: str):
@@ -32,9 +112,14 @@ def build_vectorstore(documents, persist_dir: str):
     chunks = splitter.split_documents(documents)
     
     # Crear las incrustaciones (embeddings) usando HuggingFace
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    embeddings = _get_embedding_model()
     # Crear y persistir el vectorstore con Chroma
-    vectordb = Chroma.from_documents(chunks, embeddings, persist_directory=persist_dir)
+    vectordb = Chroma.from_documents(
+        chunks,
+        embeddings,
+        persist_directory=persist_dir,
+        collection_metadata=HNSW_COLLECTION_METADATA,
+    )
     vectordb.persist()  # Guardar el vectorstore en el directorio
     return vectordb
 
@@ -43,10 +128,10 @@ def get_autodesk_vectorstore(persist_directory: str) -> Chroma:
     """
     Cargar un Chroma DB persistido si existe, de lo contrario, falla rápidamente.
     """
-    embedder = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    embedder = _get_embedding_model()
 
     db_path = Path(persist_directory)
-    if db_path.exists() and any(db_path.iterdir()):
+    if (db_path / "chroma.sqlite3").is_file():
         # Si existe el vectorstore persistido, cargarlo
         return Chroma(
             persist_directory=persist_directory,
@@ -58,16 +143,26 @@ def get_autodesk_vectorstore(persist_directory: str) -> Chroma:
             "Por favor, ejecute primero el paso de construcción (por ejemplo, usando build_vectorstore)."
         )
 
+def _get_qa_chain(vectordb: Chroma, k: int):
+    # Las cadenas ya construidas se guardan en el propio vectorstore, por k. Cada
+    # cadena referencia al vectorstore a través de su retriever, así que una caché
+    # global las mantendría vivas para siempre; en el objeto, se liberan con él
+    chains = vectordb.__dict__.setdefault("_qa_chains", {})
+    if k not in chains:
+        # Recuperador que utiliza los vectores (k = cantidad de documentos a recuperar)
+        retriever = vectordb.as_retriever(search_kwargs={"k": k})
+
+        # Crear el chain de RAG con un modelo generativo local
+        chains[k] = RetrievalQA.from_chain_type(
+            llm=_get_generator(),  # Aquí utilizamos el pipeline de Hugging Face directamente
+            retriever=retriever,
+            return_source_documents=True  # Esto es opcional, puedes ver de dónde viene la respuesta
+        )
+    return chains[k]
+
 def query_rag_system_local(query: str, vectordb: Chroma, k: int = 3):
-    # Recuperador que utiliza los vectores (k = cantidad de documentos a recuperar)
-    retriever = vectordb.as_retriever(search_kwargs={"k": k})
-
-    # Crear el chain de RAG con un modelo generativo local
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=generator,  # Aquí utilizamos el pipeline de Hugging Face directamente
-        retriever=retriever,
-        return_source_documents=True  # Esto es opcional, puedes ver de dónde viene la respuesta
-    )
+    # El retriever y el chain se reutilizan entre consultas al mismo vectorstore
+    qa_chain = _get_qa_chain(vectordb, k)
 
     # Ejecutar la consulta
     result = qa_chain(query)
@@ -88,17 +183,22 @@ persist_directory = "./persisted_vectorstore"
 ## Crear el vectorstore y guardarlo
 #vectordb = build_vectorstore(documents, persist_directory)
 
-# Cargar el vectorstore persistido (si ya existe)
-try:
-    loaded_vectordb = get_autodesk_vectorstore(persist_directory)
-    print("Vectorstore cargado exitosamente.")
-    query = "¿Hay casos en fabricas?"
-    result = query_rag_system_local(query, loaded_vectordb)
-    print("🧠 Respuesta generada por el modelo:")
-    print(result["result"])
-    print("\n📄 Documentos fuente:")
-    for doc in result["source_documents"]:
-        print(f"- Fuente: {doc.metadata.get('source', 'desconocido')}")
-        print(f"  Contenido:\n{doc.page_content[:300]}...\n")
-except FileNotFoundError as e:
-    print(str(e))
+def main():
+    # Cargar el vectorstore persistido (si ya existe)
+    try:
+        loaded_vectordb = get_autodesk_vectorstore(persist_directory)
+        print("Vectorstore cargado exitosamente.")
+        query = "¿Hay casos en fabricas?"
+        result = query_rag_system_local(query, loaded_vectordb)
+        print("🧠 Respuesta generada por el modelo:")
+        print(result["result"])
+        print("\n📄 Documentos fuente:")
+        for doc in result["source_documents"]:
+            print(f"- Fuente: {doc.metadata.get('source', 'desconocido')}")
+            print(f"  Contenido:\n{doc.page_content[:300]}...\n")
+    except FileNotFoundError as e:
+        print(str(e))
+
+
+if __name__ == "__main__":
+    main()
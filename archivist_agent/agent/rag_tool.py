@@ -1,71 +1,336 @@
+import os
+import logging
+
+def _torch_threads():
+    """
+    Hilos pedidos con RAG_TORCH_THREADS, o None para dejar el valor por defecto de
+    torch (núcleos físicos). os.cpu_count() contaría hyperthreads y, en un
+    contenedor, las CPUs del host en lugar de la cuota.
+    """
+    value = os.getenv("RAG_TORCH_THREADS")
+    if not value:
+        return None
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = 0
+    if threads < 1:
+        logging.getLogger(__name__).warning("RAG_TORCH_THREADS=%r no es válido; se ignora", value)
+        return None
+    return threads
+
+# Hilos de OpenMP/MKL para PyTorch: deben fijarse antes de que se importe torch
+TORCH_THREADS = _torch_threads()
+if TORCH_THREADS is not None:
+    os.environ.setdefault("OMP_NUM_THREADS", str(TORCH_THREADS))
+    os.environ.setdefault("MKL_NUM_THREADS", str(TORCH_THREADS))
+
+import mmap
+import threading
+import time
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import chromadb
-from llama_index.core import VectorStoreIndex, StorageContext
+from llama_index.core import StorageContext
+from llama_index.core.vector_stores import VectorStoreQuery
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.core.embeddings import resolve_embed_model  # Importa esta función
 from pathlib import Path
 from llama_index.core.settings import Settings # Importa el objeto Settings
+from _embedding_backend import onnx_model_file
+
+logger = logging.getLogger(__name__)
 
 # Cargar el vectorstore persistido
 PERSIST_DIRECTORY = "./persisted_vectorstore"
+SIMILARITY_TOP_K = 6
+
+# Parámetros HNSW de la colección (solo se aplican si la crea este módulo). Con
+# top_k=6, un search_ef de 32 basta y evita distancias de más en cada consulta
+HNSW_COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 16,
+    "hnsw:search_ef": 32,
+}
 
 # Define el modelo de embeddings
 # 'sentence-transformers/all-MiniLM-L6-v2' es un modelo open-source muy popular
-embed_model = resolve_embed_model("local:sentence-transformers/all-MiniLM-L6-v2")
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Fichero del modelo por backend. RAG_EMBEDDING_BACKEND elige "onnx" (por defecto;
+# int8 si la CPU lo acelera), "openvino" (int8, suele ser más rápido en CPUs Intel)
+# o "torch" (FP32)
+BACKEND_MODEL_FILES = {
+    "onnx": onnx_model_file(),
+    "openvino": "openvino/openvino_model_qint8_quantized.xml",
+}
+
+def load_embed_model():
+    """
+    Carga el modelo de embeddings: en GPU, PyTorch en FP16; en CPU, el backend
+    elegido y, si no está disponible, PyTorch en FP32.
+    """
+    import torch
+    if torch.cuda.is_available():
+        # El extra [onnx] instala onnxruntime para CPU: en GPU se usa PyTorch, con
+        # pesos en FP16 para los tensor cores. HuggingFaceEmbedding ya normaliza los
+        # embeddings, así que el ranking por coseno no cambia
+        model = resolve_embed_model(f"local:{EMBED_MODEL_NAME}")
+        model._model.half()
+        return model
+
+    backend = os.getenv("RAG_EMBEDDING_BACKEND", "onnx")
+    if backend in BACKEND_MODEL_FILES:
+        try:
+            from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+            return HuggingFaceEmbedding(
+                model_name=EMBED_MODEL_NAME,
+                backend=backend,
+                model_kwargs={"file_name": BACKEND_MODEL_FILES[backend]},
+            )
+        except Exception as e:
+            logger.warning("Backend %s no disponible, se usa PyTorch: %s", backend, e)
+    if TORCH_THREADS is not None:
+        torch.set_num_threads(TORCH_THREADS)
+    try:
+        # Una consulta es un único forward: el paralelismo útil es intra-op
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Solo se puede fijar una vez y antes de cualquier trabajo en paralelo
+        pass
+    return resolve_embed_model(f"local:{EMBED_MODEL_NAME}")
 
-# Configura el modelo de embeddings globalmente para LlamaIndex
-Settings.embed_model = embed_model
-# Si también usas un LLM, puedes configurarlo aquí:
-# Settings.llm = ...
+@lru_cache(maxsize=1)
+def _get_embed_model():
+    """
+    Carga el modelo de embeddings en el primer uso, no al importar el módulo.
+    """
+    embed_model = load_embed_model()
+    # Configura el modelo de embeddings globalmente para LlamaIndex
+    Settings.embed_model = embed_model
+    # Si también usas un LLM, puedes configurarlo aquí:
+    # Settings.llm = ...
+    return embed_model
+
+# Si CHROMA_HOST está definido se usa un servidor Chroma (p. ej. `chroma run --path
+# ./persisted_vectorstore`), que mantiene el índice cargado entre procesos
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+
+def _prefetch_hnsw_files(persist_directory: str) -> None:
+    """
+    Pide al sistema operativo que lea por adelantado los grafos HNSW a la caché de páginas.
+    """
+    if not hasattr(mmap, "MADV_WILLNEED"):
+        return
+    for path in Path(persist_directory).glob("*/data_level0.bin"):
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as m:
+                m.madvise(mmap.MADV_WILLNEED)
+        except (OSError, ValueError):
+            # Fichero vacío o sistema sin soporte: la precarga es solo una optimización
+            pass
 
 def get_autodesk_vectorstore(persist_directory: str) -> ChromaVectorStore:
     """
     Cargar un Chroma DB persistido si existe, de lo contrario, falla rápidamente.
+    Con CHROMA_HOST se conecta al servidor en lugar de abrir el directorio local.
     """
-    db_path = Path(persist_directory)
-    if not db_path.exists() or not any(db_path.iterdir()):
-        raise FileNotFoundError(
-            f"No se encontró un vectorstore en {persist_directory!r}. "
-            "Por favor, ejecute primero el paso de construcción (por ejemplo, usando build_vectorstore)."
-        )
+    if CHROMA_HOST:
+        db = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    else:
+        db_path = Path(persist_directory)
+        # Un stat del fichero que Chroma siempre crea, en lugar de listar el directorio
+        if not (db_path / "chroma.sqlite3").is_file():
+            raise FileNotFoundError(
+                f"No se encontró un vectorstore en {persist_directory!r}. "
+                "Por favor, ejecute primero el paso de construcción (por ejemplo, usando build_vectorstore)."
+            )
 
-    db = chromadb.PersistentClient(path=persist_directory)
+        _prefetch_hnsw_files(persist_directory)
+        db = chromadb.PersistentClient(path=persist_directory)
     collection_name = "llama_collection"
-    collection = db.get_or_create_collection(name=collection_name)
+    collection = db.get_or_create_collection(name=collection_name, metadata=HNSW_COLLECTION_METADATA)
     vector_store = ChromaVectorStore(chroma_collection=collection)
 
     return vector_store
 
+class QueryCache:
+    """
+    Caché LRU con caducidad para los resultados de retrieve_docs, segura entre hilos.
+    get() devuelve también la generación actual, que se incrementa al recargar el
+    vectorstore; put() descarta el resultado si la generación ha cambiado desde entonces.
+    """
+
+    def __init__(self, maxsize: int = 2000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _key(query: str):
+        return " ".join(query.split()).lower()
+
+    def get(self, query: str):
+        with self._lock:
+            key = self._key(query)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, self.generation
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None, self.generation
+            self._entries.move_to_end(key)
+            return value, self.generation
+
+    def put(self, query: str, value, generation: int) -> None:
+        with self._lock:
+            if generation != self.generation:
+                # Resultado calculado con un vectorstore que ya se ha recargado
+                return
+            key = self._key(query)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+_query_cache = QueryCache()
+
+# El vectorstore se abre en la primera consulta y se reutiliza. Las búsquedas van
+# directamente contra él con el embedding ya calculado, sin índice ni retriever
+_vector_store = None
+_vector_store_lock = threading.Lock()
+
+def _get_vector_store():
+    """
+    Devuelve el vectorstore, abriéndolo una sola vez por proceso. Si no existe se
+    propaga FileNotFoundError y se reintenta en la siguiente consulta.
+    """
+    global _vector_store
+    # El precalentamiento, las consultas y reload_vectorstore() pueden llegar a la vez
+    with _vector_store_lock:
+        if _vector_store is None:
+            _get_embed_model()
+            _vector_store = get_autodesk_vectorstore(PERSIST_DIRECTORY)
+            logger.debug("Vectorstore cargado exitosamente.")
+        return _vector_store
+
+def reload_vectorstore() -> None:
+    """
+    Descarta el vectorstore cargado y la caché de consultas; llamar tras reconstruirlo.
+    """
+    global _vector_store
+    with _vector_store_lock:
+        _vector_store = None
+    _query_cache.invalidate()
+
+@lru_cache(maxsize=2000)
+def _embed_query(query: str) -> tuple:
+    """
+    Embedding de la consulta, cacheado: repetirla no vuelve a tokenizar ni a pasar por el modelo.
+    """
+    return tuple(_get_embed_model().get_query_embedding(query))
+
+def _search(vector_store, embedding):
+    """
+    Busca directamente en el vectorstore con un embedding ya calculado.
+    """
+    return vector_store.query(
+        VectorStoreQuery(query_embedding=list(embedding), similarity_top_k=SIMILARITY_TOP_K)
+    )
+
+def _join_docs(docs) -> str:
+    # return "\n".join([doc.text for doc in docs]) # Esto no funciona siempre
+    # Mejor usar el método 'get_content'
+    return "\n\n---\n\n".join([doc.get_content() for doc in docs])
+
 def retrieve_docs(query: str):
     """
     Recupera documentos relevantes basados en una consulta.
     """
+    cached, generation = _query_cache.get(query)
+    if cached is not None:
+        return cached
     try:
-        loaded_vectordb = get_autodesk_vectorstore(PERSIST_DIRECTORY)
-        print("Vectorstore cargado exitosamente.")
+        # retriever.retrieve() recalcularía el embedding en cada llamada
+        vector_store = _get_vector_store()
+        retrieved_docs = _search(vector_store, _embed_query(query)).nodes or []
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("retrieved_docs: %s", retrieved_docs)
+        result = _join_docs(retrieved_docs)
+        _query_cache.put(query, result, generation)
+        return result
 
-        # LlamaIndex ya utiliza el modelo de embeddings configurado globalmente
-        # No necesitas pasarlo de nuevo aquí, a menos que quieras anularlo.
-        index = VectorStoreIndex.from_vector_store(
-            vector_store=loaded_vectordb
-        )
-        print("Index creado.")
 
+    except FileNotFoundError as e:
+        logger.error(str(e))
+    except Exception as e:
+        logger.error("Ocurrió un error inesperado: %s", e)
 
-        retriever = index.as_retriever(similarity_top_k=6)
-        print("Retriever")
-        retrieved_docs = retriever.retrieve(query)
-        print("retrieved_docs")
-        print(retrieved_docs)
-        # return "\n".join([doc.text for doc in retrieved_docs]) # Esto no funciona siempre
-        # Mejor usar el método 'get_content'
-        return "\n\n---\n\n".join([doc.get_content() for doc in retrieved_docs])
+def retrieve_docs_batch(queries: list[str]):
+    """
+    Recupera documentos para varias consultas en paralelo. Cada consulta se resuelve
+    como en retrieve_docs (mismas cachés y mismo embedding de consulta); si alguna
+    falla su posición queda a None y el resto se devuelve igualmente.
+    """
+    results = []
+    generation = None
+    for query in queries:
+        cached, generation = _query_cache.get(query)
+        results.append(cached)
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+    try:
+        vector_store = _get_vector_store()
+    except FileNotFoundError as e:
+        logger.error(str(e))
+        return results
 
+    def retrieve(query):
+        # El modelo libera el GIL durante el forward: los embeddings que no están en
+        # la caché de _embed_query se calculan en paralelo, igual que las búsquedas
+        try:
+            return _join_docs(_search(vector_store, _embed_query(query)).nodes or [])
+        except Exception as e:
+            logger.error("Ocurrió un error inesperado: %s", e)
+            return None
 
-    except FileNotFoundError as e:
-        print(str(e))
+    with ThreadPoolExecutor(max_workers=min(4, len(pending))) as ex:
+        for i, result in zip(pending, ex.map(retrieve, [queries[i] for i in pending])):
+            results[i] = result
+            if result is not None:
+                _query_cache.put(queries[i], result, generation)
+    return results
+
+def warm_up() -> None:
+    """
+    Carga modelo y vectorstore, y lanza una búsqueda desechable para que la
+    primera consulta real no pague la selección de kernels ni la carga del HNSW.
+    """
+    try:
+        vector_store = _get_vector_store()
+        _search(vector_store, _get_embed_model().get_query_embedding("warmup"))
     except Exception as e:
-        print(f"Ocurrió un error inesperado: {e}")
+        logger.warning("No se pudo precalentar el vectorstore: %s", e)
+
+# Precalentar en segundo plano, como en google_adk_rag_tools: el import termina
+# enseguida. RAG_WARMUP=0 lo desactiva (p. ej. si solo se importa para otros símbolos)
+if os.getenv("RAG_WARMUP", "1") != "0":
+    threading.Thread(target=warm_up, name="rag-warm-up", daemon=True).start()
 
-query = "¿Hay casos en fabricas?"
-retrieved_docs = retrieve_docs(query)
-print(retrieved_docs)
\ No newline at end of file
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    query = "¿Hay casos en fabricas?"
+    retrieved_docs = retrieve_docs(query)
+    print(retrieved_docs)
@@ -2,6 +2,7 @@
 from langchain_ollama import OllamaEmbeddings, OllamaLLM
 import chromadb
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 # Define the LLM model to be used
 llm_model = "llama3.2:1b"
@@ -16,8 +17,11 @@ class ChromaDBEmbeddingFunction:
     """
     Custom embedding function for ChromaDB using embeddings from Ollama.
     """
-    def __init__(self, langchain_embeddings):
+    def __init__(self, langchain_embeddings, batch_size=100, max_workers=8):
         self.langchain_embeddings = langchain_embeddings
+        # Number of texts per embedding request and how many requests run at once
+        self.batch_size = batch_size
+        self.max_workers = max_workers
 
     def name(self):
         return "OllamaEmbeddingFunction"
@@ -25,8 +29,16 @@ class ChromaDBEmbeddingFunction:
     # This method is used for embedding documents
     def __call__(self, input):
         # ChromaDB expects this method to handle both single strings and lists.
-        
-        return self.langchain_embeddings.embed_documents(input)
+        if isinstance(input, str) or len(input) <= self.batch_size:
+            return self.langchain_embeddings.embed_documents(input)
+
+        # Large inputs are split into sub-batches embedded concurrently, so the
+        # network round-trips to Ollama overlap instead of running one by one.
+        # map() keeps the batch order, so the embeddings line up with the input.
+        batches = [input[i:i + self.batch_size] for i in range(0, len(input), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+            results = executor.map(self.langchain_embeddings.embed_documents, batches)
+        return [embedding for batch in results for embedding in batch]
 
     # This method is used for embedding queries.
     # It must handle the input from ChromaDB, which is a single string.
@@ -75,9 +87,6 @@ documents = [
 ]
 doc_ids = ["doc1", "doc2", "doc3"]
 
-# Documents only need to be added once or whenever an update is required. 
-# This line of code is included for demonstration purposes:
-add_documents_to_collection(documents, doc_ids)
 
 # Function to query the ChromaDB collection
 def query_chromadb(query_text, n_results=1):
@@ -97,6 +106,19 @@ def query_chromadb(query_text, n_results=1):
     )
     return results["documents"], results["metadatas"]
 
+# The Ollama LLM client is created once and reused, so every prompt goes
+# through the same HTTP connection pool instead of a fresh client
+_llm = None
+
+def _get_llm():
+    """
+    Return the shared Ollama LLM client, creating it on first use.
+    """
+    global _llm
+    if _llm is None:
+        _llm = OllamaLLM(model=llm_model)
+    return _llm
+
 # Function to interact with the Ollama LLM
 def query_ollama(prompt):
     """
@@ -108,8 +130,7 @@ def query_ollama(prompt):
     Returns:
         str: The response from Ollama.
     """
-    llm = OllamaLLM(model=llm_model)
-    return llm.invoke(prompt)
+    return _get_llm().invoke(prompt)
 
 # RAG pipeline: Combine ChromaDB and Ollama for Retrieval-Augmented Generation
 def rag_pipeline(query_text):
@@ -135,7 +156,12 @@ def rag_pipeline(query_text):
     return response
 
 # Example usage
-# Define a query to test the RAG pipeline
-query = "What is artificial intelligence?"  # Change the query as needed
-response = rag_pipeline(query)
-print("######## Response from LLM ########\n", response)
\ No newline at end of file
+if __name__ == "__main__":
+    # Documents only need to be added once or whenever an update is required. 
+    # This line of code is included for demonstration purposes:
+    add_documents_to_collection(documents, doc_ids)
+
+    # Define a query to test the RAG pipeline
+    query = "What is artificial intelligence?"  # Change the query as needed
+    response = rag_pipeline(query)
+    print("######## Response from LLM ########\n", response)